@@ -0,0 +1,50 @@
+"""On-disk cache for the results of build probes
+
+Probes like pkg-config lookups and test compiles only depend on their
+inputs (compiler, flags, prefix), so their results can be reused
+across setup.py invocations.
+"""
+
+# Copyright (c) PyZMQ Developers
+# Distributed under the terms of the Modified BSD License.
+
+import functools
+import hashlib
+import json
+import os
+
+from .config import load_config, save_config
+
+pjoin = os.path.join
+
+cache_dir = pjoin('build', '.probe-cache')
+
+
+def disk_cached(key_fn):
+    """Decorator caching the JSON-able result of a probe on disk
+
+    key_fn is called with the same arguments as the probe,
+    and must return a JSON-able description of everything the result depends on.
+    Results are stored in build/.probe-cache/<sha1 of key>.json.
+
+    Exceptions and None results are not cached,
+    so a probe that failed is retried next time.
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def cached(*args, **kwargs):
+            key = json.dumps([f.__name__, key_fn(*args, **kwargs)], sort_keys=True)
+            name = hashlib.sha1(key.encode('utf8')).hexdigest()
+            entry = load_config(name, cache_dir)
+            if 'result' in entry:
+                return entry['result']
+            result = f(*args, **kwargs)
+            if result is None:
+                return result
+            save_config(name, {'key': key, 'result': result}, cache_dir)
+            return result
+
+        return cached
+
+    return decorator
@@ -100,20 +100,25 @@ def fetch_archive(savedir, url, fname, checksum, force=False):
 
     if os.path.exists(dest) and not force:
         info("already have %s" % dest)
-        digest = checksum_file(scheme, fname)
+        digest = checksum_file(scheme, dest)
         if digest == digest_ref or not digest_ref:
             return dest
         else:
             warn("but checksum %s != %s, redownloading." % (digest, digest_ref))
-            os.remove(fname)
+            os.remove(dest)
 
     info("fetching %s into %s" % (url, savedir))
     if not os.path.exists(savedir):
         os.makedirs(savedir)
-    req = urlopen(url)
-    with open(dest, 'wb') as f:
-        f.write(req.read())
-    digest = checksum_file(scheme, dest)
+    # hash while streaming to disk, instead of reading the file back
+    h = getattr(hashlib, scheme)()
+    with urlopen(url) as req, open(dest, 'wb') as f:
+        chunk = req.read(65535)
+        while chunk:
+            h.update(chunk)
+            f.write(chunk)
+            chunk = req.read(65535)
+    digest = h.hexdigest()
     if digest_ref and digest != digest_ref:
         fatal(
             "%s %s mismatch:\nExpected: %s\nActual  : %s"
@@ -11,11 +11,11 @@
 #  the file COPYING.BSD, distributed as part of this software.
 # -----------------------------------------------------------------------------
 
+import copy
+import functools
 import sys
 import os
-import json
-
-from configparser import ConfigParser
+import re
 
 pjoin = os.path.join
 from .msg import debug, fatal, warn
@@ -25,32 +25,144 @@ from .msg import debug, fatal, warn
 # -----------------------------------------------------------------------------
 
 
-def load_config(name, base='conf'):
-    """Load config dict from JSON"""
+# file names in directories we read config from, see _listdir
+_dir_cache = {}
+
+
+def _listdir(path):
+    """Return the set of names in a directory, empty if it doesn't exist
+
+    Each directory is only scanned once per process,
+    save_config keeps the result up to date for files it creates.
+    """
+    try:
+        return _dir_cache[path]
+    except KeyError:
+        pass
+    try:
+        with os.scandir(path) as entries:
+            names = {entry.name for entry in entries}
+    except OSError:
+        names = set()
+    _dir_cache[path] = names
+    return names
+
+
+def _exists(path):
+    """Cached check for whether path exists, via _listdir"""
+    dirname, basename = os.path.split(path)
+    return basename in _listdir(dirname or os.curdir)
+
+
+def _stat_key(path):
+    """Return (mtime, size) of a file, or None if it doesn't exist"""
+    if not _exists(path):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _json():
+    """Return (loads, dumps) for config files
+
+    Uses orjson if it is available, json otherwise.
+    dumps returns indented JSON as bytes.
+    """
+    try:
+        import orjson
+    except ImportError:
+        import json
+
+        def dumps(data):
+            return json.dumps(data, indent=2).encode('utf8')
+
+        return json.loads, dumps
+
+    def dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+    return orjson.loads, dumps
+
+
+@functools.lru_cache(maxsize=None)
+def _load_config(name, base):
     fname = pjoin(base, name + '.json')
-    if not os.path.exists(fname):
+    if not _exists(fname):
+        return {}
+    try:
+        with open(fname, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        warn("Couldn't load %s: %s" % (fname, e))
         return {}
+    loads, _ = _json()
     try:
-        with open(fname) as f:
-            cfg = json.load(f)
+        cfg = loads(data)
     except Exception as e:
         warn("Couldn't load %s: %s" % (fname, e))
         cfg = {}
     return cfg
 
 
+def load_config(name, base='conf'):
+    """Load config dict from JSON
+
+    The parsed file is cached for the lifetime of the process,
+    callers get their own copy.
+    """
+    return copy.deepcopy(_load_config(name, base))
+
+
+def dump_config(data):
+    """Serialize a config dict to JSON bytes, for write_config"""
+    _, dumps = _json()
+    return dumps(data)
+
+
+def write_config(name, buf, base='conf'):
+    """Write serialized config to base/name.json
+
+    The file is replaced atomically,
+    so readers never see a partially written config.
+    """
+    os.makedirs(base, exist_ok=True)
+    fname = pjoin(base, name + '.json')
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(buf)
+    os.replace(tmp_fname, fname)
+    dirname = os.path.dirname(fname) or os.curdir
+    if dirname in _dir_cache:
+        _dir_cache[dirname].add(name + '.json')
+    # drop anything cached from the previous contents
+    _load_config.cache_clear()
+    _discover_settings.cache_clear()
+
+
 def save_config(name, data, base='conf'):
     """Save config dict to JSON"""
-    if not os.path.exists(base):
-        os.mkdir(base)
-    fname = pjoin(base, name + '.json')
-    with open(fname, 'w') as f:
-        json.dump(data, f, indent=2)
+    write_config(name, dump_config(data), base)
 
 
 def v_str(v_tuple):
     """turn (2,0,1) into '2.0.1'."""
-    return ".".join(str(x) for x in v_tuple)
+    if len(v_tuple) == 3:
+        return "%s.%s.%s" % tuple(v_tuple)
+    return ".".join(map(str, v_tuple))
+
+
+# environment variables picked up by get_env_args:
+# (variable, settings key, conversion)
+_env_vars = (
+    ('ZMQ_PREFIX', 'zmq_prefix', str),
+    ('ZMQ_DRAFT_API', 'zmq_draft_api', lambda value: int(value or 0)),
+)
 
 
 def get_env_args():
@@ -58,37 +170,84 @@ def get_env_args():
 
     settings = {}
 
-    zmq = os.environ.get("ZMQ_PREFIX")
-    if zmq:
-        debug("Found environ var ZMQ_PREFIX=%s" % zmq)
-        settings['zmq_prefix'] = zmq
-    draft_api = os.environ.get("ZMQ_DRAFT_API")
-    if draft_api:
-        debug("Found environ var ZMQ_DRAFT_API=%s" % draft_api)
-        settings['zmq_draft_api'] = int(draft_api)
+    env = os.environ
+    for var, key, convert in _env_vars:
+        value = env.get(var)
+        if value is None:
+            continue
+        debug("Found environ var %s=%s" % (var, value))
+        settings[key] = convert(value)
 
     return settings
 
 
-def cfg2dict(cfg):
-    """turn a ConfigParser into a nested dict
+# values accepted for boolean keys in setup.cfg
+_bools = {
+    'true': True,
+    'false': False,
+    '1': True,
+    '0': False,
+    'yes': True,
+    'no': False,
+    'on': True,
+    'off': False,
+    # bundle_msvcp defaults to None
+    'none': None,
+}
+
+_section_pat = re.compile(r'^\[([^\]]+)\]\s*$')
+_option_pat = re.compile(r'^([^:=\s][^:=]*?)\s*[:=]\s*(.*)$')
+
 
-    because ConfigParser objects are dumb.
+def _parse_cfg(f):
+    """parse setup.cfg-style lines into a nested dict
+
+    Handles the subset of ConfigParser syntax used in setup.cfg:
+    sections, `key = value` / `key: value`, full-line comments
+    and indented continuation lines. No interpolation is performed.
     """
-    d = {}
-    for section in cfg.sections():
-        d[section] = dict(cfg.items(section))
-    return d
+    cfg = {}
+    section = None
+    key = None
+    for lineno, line in enumerate(f, 1):
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#;':
+            continue
+        if line[0].isspace() and key is not None:
+            # continuation of the previous value
+            section[key] = section[key] + '\n' + stripped
+            continue
+        key = None
+        m = _section_pat.match(stripped)
+        if m:
+            section = cfg.setdefault(m.group(1), {})
+            continue
+        m = _option_pat.match(stripped)
+        if m and section is not None:
+            key = m.group(1).lower()
+            section[key] = m.group(2)
+        else:
+            warn("Ignoring bad line %i in setup.cfg: %r" % (lineno, stripped))
+    return cfg
 
 
 def get_cfg_args():
     """ Look for options in setup.cfg """
 
-    if not os.path.exists('setup.cfg'):
+    stat_key = _stat_key('setup.cfg')
+    if stat_key is None:
         return {}
-    cfg = ConfigParser()
-    cfg.read('setup.cfg')
-    cfg = cfg2dict(cfg)
+    return copy.deepcopy(_read_setup_cfg(os.path.abspath('setup.cfg'), stat_key))
+
+
+@functools.lru_cache(maxsize=None)
+def _read_setup_cfg(path, stat_key):
+    """Parse setup.cfg at path
+
+    stat_key is only used to invalidate the cache when the file changes.
+    """
+    with open(path) as f:
+        cfg = _parse_cfg(f)
 
     g = cfg.setdefault('global', {})
     # boolean keys:
@@ -101,29 +260,53 @@ def get_cfg_args():
         'bundle_msvcp',
     ]:
         if key in g:
-            g[key] = eval(g[key])
+            # allow an inline comment, as in setup.cfg.template
+            value = g[key].split('#', 1)[0].strip().lower()
+            if value not in _bools:
+                fatal(
+                    "Bad value for %s in setup.cfg: %r (expected True or False)"
+                    % (key, g[key])
+                )
+            g[key] = _bools[value]
 
     # globals go to top level
     cfg.update(cfg.pop('global'))
     return cfg
 
 
+# settings for each kind of zmq prefix, see config_from_prefix
+_prefix_auto = {
+    'zmq_prefix': '',
+    'libzmq_extension': False,
+    'no_libzmq_extension': False,
+}
+_prefix_bundled = {
+    'zmq_prefix': '',
+    'libzmq_extension': True,
+    'no_libzmq_extension': False,
+}
+_prefix_explicit = {
+    'libzmq_extension': False,
+    'no_libzmq_extension': True,
+    'allow_legacy_libzmq': True,  # explicit zmq prefix allows legacy
+}
+
+
 def config_from_prefix(prefix):
     """Get config from zmq prefix"""
-    settings = {}
-    if prefix.lower() in ('default', 'auto', ''):
-        settings['zmq_prefix'] = ''
-        settings['libzmq_extension'] = False
-        settings['no_libzmq_extension'] = False
-    elif prefix.lower() in ('bundled', 'extension'):
-        settings['zmq_prefix'] = ''
-        settings['libzmq_extension'] = True
-        settings['no_libzmq_extension'] = False
+    lprefix = prefix.lower()
+    if lprefix in ('default', 'auto', ''):
+        return _prefix_auto.copy()
+    elif lprefix in ('bundled', 'extension'):
+        return _prefix_bundled.copy()
+
+    # abspath normalizes too, only needed (with its getcwd) for relative paths
+    if os.path.isabs(prefix):
+        prefix = os.path.normpath(prefix)
     else:
-        settings['zmq_prefix'] = os.path.abspath(prefix)
-        settings['libzmq_extension'] = False
-        settings['no_libzmq_extension'] = True
-        settings['allow_legacy_libzmq'] = True  # explicit zmq prefix allows legacy
+        prefix = os.path.abspath(prefix)
+    settings = {'zmq_prefix': prefix}
+    settings.update(_prefix_explicit)
     return settings
 
 
@@ -132,51 +315,80 @@ def merge(into, d):
 
     into is updated, d has priority
     """
-    if isinstance(into, dict):
-        for key in d.keys():
-            if key not in into:
-                into[key] = d[key]
-            else:
-                into[key] = merge(into[key], d[key])
-        return into
-    elif isinstance(into, list):
+    if type(into) is list:
         return into + d
-    else:
+    elif type(into) is not dict:
         return d
 
+    # walk nested dicts with an explicit stack instead of recursing
+    stack = [(into, d)]
+    while stack:
+        into_node, d_node = stack.pop()
+        for key, value in d_node.items():
+            if key not in into_node:
+                into_node[key] = value
+                continue
+            current = into_node[key]
+            if type(current) is dict:
+                stack.append((current, value))
+            elif type(current) is list:
+                into_node[key] = current + value
+            else:
+                into_node[key] = value
+    return into
+
+
+_IS_WIN = sys.platform.startswith('win')
+
+_default_settings = {
+    'zmq_prefix': '',
+    'zmq_draft_api': False,
+    'libzmq_extension': False,
+    'no_libzmq_extension': False,
+    'skip_check_zmq': False,
+    'allow_legacy_libzmq': False,
+    'bundle_msvcp': None,
+    'build_ext': {},
+    'bdist_egg': {},
+    'win_ver': None,
+}
+
+if _IS_WIN:
+    _default_settings['have_sys_un_h'] = False
+    # target Windows version, sets WINVER, _WIN32_WINNT macros
+    # see https://docs.microsoft.com/en-us/cpp/porting/modifying-winver-and-win32-winnt for reference
+    # see https://github.com/python/cpython/blob/v3.9.1/PC/pyconfig.h#L137-L159
+    # for CPython's own values
+    if sys.version_info >= (3, 9):
+        # CPython 3.9 targets Windows 8 (0x0602)
+        _default_settings["win_ver"] = "0x0602"
+    else:
+        # older Python, target Windows 7 (0x0601)
+        # CPython itself targets Vista (0x0600)
+        _default_settings["win_ver"] = "0x0601"
+
 
 def discover_settings(conf_base=None):
     """ Discover custom settings for ZMQ path"""
-    settings = {
-        'zmq_prefix': '',
-        'zmq_draft_api': False,
-        'libzmq_extension': False,
-        'no_libzmq_extension': False,
-        'skip_check_zmq': False,
-        'allow_legacy_libzmq': False,
-        'bundle_msvcp': None,
-        'build_ext': {},
-        'bdist_egg': {},
-        'win_ver': None,
-    }
-    if sys.platform.startswith('win'):
-        settings['have_sys_un_h'] = False
-        # target Windows version, sets WINVER, _WIN32_WINNT macros
-        # see https://docs.microsoft.com/en-us/cpp/porting/modifying-winver-and-win32-winnt for reference
-        # see https://github.com/python/cpython/blob/v3.9.1/PC/pyconfig.h#L137-L159
-        # for CPython's own values
-        if sys.version_info >= (3, 9):
-            # CPython 3.9 targets Windows 8 (0x0602)
-            settings["win_ver"] = "0x0602"
-        else:
-            # older Python, target Windows 7 (0x0601)
-            # CPython itself targets Vista (0x0600)
-            settings["win_ver"] = "0x0601"
+    env_args = tuple(sorted(get_env_args().items()))
+    settings = _discover_settings(conf_base, _stat_key('setup.cfg'), env_args)
+    return copy.deepcopy(settings)
+
+
+@functools.lru_cache(maxsize=None)
+def _discover_settings(conf_base, cfg_key, env_args):
+    """Merge default, conf, setup.cfg and env settings
+
+    cfg_key and env_args are the inputs not covered by the
+    load_config cache, so that changes to them invalidate the result.
+    """
+    # deep copy: merge() updates the nested build_ext/bdist_egg dicts in place
+    settings = copy.deepcopy(_default_settings)
 
     if conf_base:
         # lowest priority
         merge(settings, load_config('config', conf_base))
     merge(settings, get_cfg_args())
-    merge(settings, get_env_args())
+    merge(settings, dict(env_args))
 
     return settings
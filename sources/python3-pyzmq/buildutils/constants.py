@@ -84,6 +84,15 @@ def generate_file(fname, ns_func, dest_dir="."):
         tpl = f.read()
     out = tpl.format(**ns_func())
     dest = pjoin(dest_dir, fname)
+    try:
+        with open(dest, 'r') as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = None
+    if out == current:
+        # leave mtime alone so Cython doesn't rebuild everything that includes it
+        info("%s is up to date" % dest)
+        return
     info("generating %s from template" % dest)
     with open(dest, 'w') as f:
         f.write(out)
@@ -55,7 +55,8 @@ def patch_lib_paths(fname, library_dirs):
     - Find libraries with `otool -L`
     - Update with `install_name_tool -change`
     """
-    if sys.platform != 'darwin':
+    if sys.platform != 'darwin' or not library_dirs:
+        # nowhere to find libraries, no need to run otool
         return
 
     libs = _get_libs(fname)
@@ -18,23 +18,17 @@
 
 from __future__ import with_statement, print_function
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-import copy
-import io
 import os
 import shutil
 import subprocess
 import sys
 import time
 import errno
+import functools
 import platform
-from pprint import pprint
-from traceback import print_exc
-
-try:
-    import cffi
-except ImportError:
-    cffi = None
+import re
 
 from setuptools import setup, Command
 from setuptools.command.bdist_egg import bdist_egg
@@ -43,21 +37,22 @@ from setuptools.command.sdist import sdist
 from setuptools.extension import Extension
 
 import distutils.util
-from distutils.ccompiler import get_default_compiler
+from distutils.ccompiler import CCompiler, get_default_compiler
 from distutils.ccompiler import new_compiler
 from distutils.sysconfig import customize_compiler, get_config_var
-from distutils.version import LooseVersion as V
 
 from glob import glob
-from os.path import splitext, basename, join as pjoin
+from os.path import join as pjoin
 
-from subprocess import Popen, PIPE, check_call, CalledProcessError
+from subprocess import Popen
 
 # local script imports:
 from buildutils import (
     discover_settings,
     v_str,
-    save_config,
+    load_config,
+    dump_config,
+    write_config,
     detect_zmq,
     merge,
     config_from_prefix,
@@ -76,6 +71,7 @@ from buildutils import (
     compile_and_forget,
     patch_lib_paths,
 )
+from buildutils._probe_cache import disk_cached
 
 # -----------------------------------------------------------------------------
 # Flags
@@ -85,7 +81,6 @@ from buildutils import (
 # name of the libzmq library - can be changed by --libzmq <name>
 libzmq_name = "libzmq"
 
-doing_bdist = any(arg.startswith("bdist") for arg in sys.argv[1:])
 pypy = platform.python_implementation() == 'PyPy'
 
 # reference points for zmq compatibility
@@ -95,47 +90,108 @@ min_good_zmq = (3, 2)
 target_zmq = bundled_version
 dev_zmq = (target_zmq[0], target_zmq[1] + 1, 0)
 
+# platform flags
+_IS_WIN = sys.platform.startswith('win')
+_IS_DARWIN = sys.platform == 'darwin'
+_IS_LINUX = sys.platform.startswith('linux')
+_IS_FREEBSD = sys.platform.startswith('freebsd')
+_IS_SUNOS = sys.platform.startswith('sunos')
+_IS_BSD = 'bsd' in sys.platform
+
 # set dylib ext:
-if sys.platform.startswith('win'):
+if _IS_WIN:
     lib_ext = '.dll'
-elif sys.platform == 'darwin':
+elif _IS_DARWIN:
     lib_ext = '.dylib'
 else:
     lib_ext = '.so'
 
-# allow `--zmq=foo` to be passed at any point,
-# but always assign it to configure
+# polling subsystem for bundled libzmq, by platform
+_PLATFORM_MACROS = {
+    'kqueue': [
+        ('ZMQ_USE_KQUEUE', 1),
+        ('ZMQ_IOTHREADS_USE_KQUEUE', 1),
+        ('ZMQ_POLL_BASED_ON_POLL', 1),
+    ],
+    'linux': [
+        ('ZMQ_USE_EPOLL', 1),
+        ('ZMQ_IOTHREADS_USE_EPOLL', 1),
+        ('ZMQ_POLL_BASED_ON_POLL', 1),
+    ],
+    'win32': [
+        ('ZMQ_USE_SELECT', 1),
+        ('ZMQ_IOTHREADS_USE_SELECT', 1),
+        ('ZMQ_POLL_BASED_ON_SELECT', 1),
+    ],
+    # this may not be sufficiently precise
+    '_default': [
+        ('ZMQ_USE_POLL', 1),
+        ('ZMQ_IOTHREADS_USE_POLL', 1),
+        ('ZMQ_POLL_BASED_ON_POLL', 1),
+    ],
+}
 
-configure_idx = -1
-fetch_idx = -1
-for idx, arg in enumerate(list(sys.argv)):
-    # track index of configure and fetch_libzmq
-    if arg == 'configure':
-        configure_idx = idx
-    elif arg == 'fetch_libzmq':
-        fetch_idx = idx
+if _IS_DARWIN or _IS_BSD:
+    _platform_macros_key = 'kqueue'
+elif _IS_LINUX:
+    _platform_macros_key = 'linux'
+elif _IS_WIN:
+    _platform_macros_key = 'win32'
+else:
+    _platform_macros_key = '_default'
+
+
+def _rewrite_argv(argv):
+    """Pull our own options out of argv in a single pass
 
-    if arg.startswith('--zmq='):
-        sys.argv.pop(idx)
+    `--zmq=foo` is allowed at any point, but always assigned to configure,
+    which is added to the command-line if it isn't already there.
+
+    Returns (new_argv, doing_bdist, libzmq_name, enable_drafts)
+    """
+    new_argv = argv[:1]
+    configure_idx = -1
+    fetch_idx = -1
+    zmq_arg = None
+    doing_bdist = False
+    name = libzmq_name
+    enable_drafts = False
+    for arg in argv[1:]:
+        if arg.startswith('bdist'):
+            doing_bdist = True
+        if zmq_arg is None and arg.startswith('--zmq='):
+            zmq_arg = arg
+        elif arg.startswith('--libzmq='):
+            name = arg.split("=", 1)[1]
+        elif arg == '--enable-drafts':
+            enable_drafts = True
+        else:
+            # track index of configure and fetch_libzmq
+            # preceding the first --zmq= arg
+            if zmq_arg is None:
+                if arg == 'configure':
+                    configure_idx = len(new_argv)
+                elif arg == 'fetch_libzmq':
+                    fetch_idx = len(new_argv)
+            new_argv.append(arg)
+
+    if zmq_arg is not None:
         if configure_idx < 0:
             if fetch_idx < 0:
                 configure_idx = 1
             else:
                 configure_idx = fetch_idx + 1
-            sys.argv.insert(configure_idx, 'configure')
-        sys.argv.insert(configure_idx + 1, arg)
-        break
+            new_argv.insert(configure_idx, 'configure')
+        new_argv.insert(configure_idx + 1, zmq_arg)
 
-for idx, arg in enumerate(list(sys.argv)):
-    if arg.startswith('--libzmq='):
-        sys.argv.remove(arg)
-        libzmq_name = arg.split("=", 1)[1]
-    if arg == '--enable-drafts':
-        sys.argv.remove(arg)
-        os.environ['ZMQ_DRAFT_API'] = '1'
+    return new_argv, doing_bdist, name, enable_drafts
 
 
-if sys.platform.startswith('win'):
+sys.argv[:], doing_bdist, libzmq_name, _enable_drafts = _rewrite_argv(sys.argv)
+if _enable_drafts:
+    os.environ['ZMQ_DRAFT_API'] = '1'
+
+if _IS_WIN:
     # ensure vcredist is on PATH
     locate_vcredist_dir()
 else:
@@ -151,6 +207,21 @@ else:
             cxx = "c++ -pthread"
         os.environ["CXX"] = cxx + " " + cxx_flags
 
+# prefix compile commands with a compiler cache (ccache) if one is found.
+# set PYZMQ_COMPILER_CACHE to use another (e.g. sccache),
+# or PYZMQ_NO_CCACHE=1 to disable.
+compiler_launcher = None
+if not os.environ.get("PYZMQ_NO_CCACHE"):
+    compiler_launcher = shutil.which(os.environ.get("PYZMQ_COMPILER_CACHE", "ccache"))
+if compiler_launcher:
+    # allow cache hits across checkouts and pip's temporary build directories,
+    # where every file is freshly extracted
+    os.environ.setdefault("CCACHE_BASEDIR", os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault("CCACHE_SLOPPINESS", "time_macros,include_file_mtime")
+    # identify the compiler by its contents rather than its path and mtime,
+    # so reinstalled or relocated toolchains still hit the cache
+    os.environ.setdefault("CCACHE_COMPILERCHECK", "content")
+
 # -----------------------------------------------------------------------------
 # Configuration (adapted from h5py: https://www.h5py.org/)
 # -----------------------------------------------------------------------------
@@ -167,9 +238,9 @@ def bundled_settings(debug):
     settings['runtime_library_dirs'] = []
     # add pthread on freebsd
     # is this necessary?
-    if sys.platform.startswith('freebsd'):
+    if _IS_FREEBSD:
         settings['libraries'].append('pthread')
-    elif sys.platform.startswith('win'):
+    elif _IS_WIN:
         # link against libzmq in build dir:
         plat = distutils.util.get_platform()
         temp = 'temp.%s-%i.%i' % (plat, sys.version_info[0], sys.version_info[1])
@@ -177,7 +248,7 @@ def bundled_settings(debug):
             temp += '-pydebug'
 
         # Python 3.5 adds EXT_SUFFIX to libs
-        ext_suffix = distutils.sysconfig.get_config_var("EXT_SUFFIX")
+        ext_suffix = get_config_var("EXT_SUFFIX")
         suffix = os.path.splitext(ext_suffix)[0]
 
         if debug:
@@ -193,26 +264,28 @@ def bundled_settings(debug):
 
 def check_pkgconfig():
     """ pull compile / link flags from pkg-config if present. """
-    pcfg = None
     zmq_config = None
+    pkg_config = os.environ.get('PKG_CONFIG', 'pkg-config')
     try:
-        pkg_config = os.environ.get('PKG_CONFIG', 'pkg-config')
-        check_call([pkg_config, '--exists', 'libzmq'])
+        # a single call: a non-zero exit means libzmq wasn't found.
         # this would arguably be better with --variable=libdir /
         # --variable=includedir, but would require multiple calls
         pcfg = Popen(
-            [pkg_config, '--libs', '--cflags', 'libzmq'], stdout=subprocess.PIPE
+            [pkg_config, '--libs', '--cflags', 'libzmq'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
+        output, _ = pcfg.communicate()
     except OSError as osexception:
         if osexception.errno == errno.ENOENT:
             info('pkg-config not found')
         else:
             warn("Running pkg-config failed - %s." % osexception)
-    except CalledProcessError:
-        info("Did not find libzmq via pkg-config.")
+        return zmq_config
 
-    if pcfg is not None:
-        output, _ = pcfg.communicate()
+    if pcfg.returncode:
+        info("Did not find libzmq via pkg-config.")
+    else:
         output = output.decode('utf8', 'replace')
         bits = output.strip().split()
         zmq_config = {'library_dirs': [], 'include_dirs': [], 'libraries': []}
@@ -233,12 +306,30 @@ def _add_rpath(settings, path):
 
     Implemented here because distutils runtime_library_dirs doesn't do anything on darwin
     """
-    if sys.platform == 'darwin':
+    if _IS_DARWIN:
         settings['extra_link_args'].extend(['-Wl,-rpath', '-Wl,%s' % path])
     else:
         settings['runtime_library_dirs'].append(path)
 
 
+def scan_dir(path, suffix, exclude=()):
+    """List the files in path ending with suffix, like glob(path/*suffix)
+
+    Uses a single scandir, filtering on names only.
+    Names starting with any prefix in exclude are skipped.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return [
+                entry.path
+                for entry in entries
+                if entry.name.endswith(suffix)
+                and not entry.name.startswith(('.',) + tuple(exclude))
+            ]
+    except FileNotFoundError:
+        return []
+
+
 def settings_from_prefix(prefix=None):
     """load appropriate library/include settings from ZMQ prefix"""
     settings = {}
@@ -248,7 +339,7 @@ def settings_from_prefix(prefix=None):
     settings['runtime_library_dirs'] = []
     settings['extra_link_args'] = []
 
-    if sys.platform.startswith('win'):
+    if _IS_WIN:
         global libzmq_name
 
         if prefix:
@@ -278,10 +369,10 @@ def settings_from_prefix(prefix=None):
 
     else:
         # add pthread on freebsd
-        if sys.platform.startswith('freebsd'):
+        if _IS_FREEBSD:
             settings['libraries'].append('pthread')
 
-        if sys.platform.startswith('sunos'):
+        if _IS_SUNOS:
             if platform.architecture()[0] == '32bit':
                 settings['extra_link_args'] += ['-m32']
             else:
@@ -291,10 +382,7 @@ def settings_from_prefix(prefix=None):
             settings['libraries'].append('zmq')
 
             settings['include_dirs'] += [pjoin(prefix, 'include')]
-            if (
-                sys.platform.startswith('sunos')
-                and platform.architecture()[0] == '64bit'
-            ):
+            if _IS_SUNOS and platform.architecture()[0] == '64bit':
                 settings['library_dirs'] += [pjoin(prefix, 'lib/amd64')]
             settings['library_dirs'] += [pjoin(prefix, 'lib')]
         else:
@@ -309,7 +397,7 @@ def settings_from_prefix(prefix=None):
             else:
                 settings['libraries'].append('zmq')
 
-                if sys.platform == 'darwin' and os.path.isdir('/opt/local/lib'):
+                if _IS_DARWIN and os.path.isdir('/opt/local/lib'):
                     # allow macports default
                     settings['include_dirs'] += ['/opt/local/include']
                     settings['library_dirs'] += ['/opt/local/lib']
@@ -378,14 +466,15 @@ class Configure(build_ext):
 
     def save_config(self, name, cfg):
         """write config to JSON"""
-        save_config(name, cfg, self.build_base)
+        buf = dump_config(cfg)
+        write_config(name, buf, self.build_base)
         # write to zmq.utils.[name].json
-        save_config(name, cfg, os.path.join('zmq', 'utils'))
+        write_config(name, buf, os.path.join('zmq', 'utils'))
         # also write to build_lib, because we might be run after copying to
         # build_lib has already happened.
         build_lib_utils = os.path.join(self.build_lib, 'zmq', 'utils')
         if os.path.exists(build_lib_utils):
-            save_config(name, cfg, build_lib_utils)
+            write_config(name, buf, build_lib_utils)
 
     def init_settings_from_config(self):
         """set up compiler settings, based on config"""
@@ -397,22 +486,7 @@ class Configure(build_ext):
             settings = settings_from_prefix(cfg['zmq_prefix'])
 
         if 'have_sys_un_h' not in cfg:
-            # don't link against anything when checking for sys/un.h
-            minus_zmq = copy.deepcopy(settings)
-            try:
-                minus_zmq['libraries'] = []
-            except Exception:
-                pass
-            try:
-                compile_and_forget(
-                    self.tempdir, pjoin('buildutils', 'check_sys_un.c'), **minus_zmq
-                )
-            except Exception as e:
-                warn("No sys/un.h, IPC_PATH_MAX_LEN will be undefined: %s" % e)
-                cfg['have_sys_un_h'] = False
-            else:
-                cfg['have_sys_un_h'] = True
-
+            cfg['have_sys_un_h'] = self.check_sys_un_h(settings)
             self.save_config('config', cfg)
 
         settings.setdefault('define_macros', [])
@@ -444,17 +518,63 @@ class Configure(build_ext):
 
         settings.setdefault('libraries', [])
         # Explicitly link dependencies, not necessary if zmq is dynamic
-        if sys.platform.startswith('win'):
+        if _IS_WIN:
             settings['libraries'].extend(('ws2_32', 'iphlpapi', 'advapi32'))
 
+        self.compiler_settings = settings
+        self.apply_compiler_settings()
+        self.save_config('compiler', settings)
+
+    def apply_compiler_settings(self):
+        """apply compiler_settings to our extensions (except libzmq itself)
+
+        Each extension gets its own copy of list settings,
+        so changes to one extension don't leak into the others.
+        """
+        settings = self.compiler_settings
         for ext in self.distribution.ext_modules:
             if ext.name.startswith('zmq.lib'):
                 continue
             for attr, value in settings.items():
+                if isinstance(value, list):
+                    value = list(value)
                 setattr(ext, attr, value)
 
-        self.compiler_settings = settings
-        self.save_config('compiler', settings)
+    def _probe_compiler_so(self):
+        """The compile command probes like check_sys_un_h will use
+
+        e.g. from $CC, to tell compilers of the same compiler_type apart.
+        None for compilers without compiler_so (msvc).
+        """
+        cc = new_compiler(compiler=self.compiler_type)
+        customize_compiler(cc)
+        return getattr(cc, 'compiler_so', None)
+
+    @disk_cached(
+        lambda self, settings: [
+            self.compiler_type,
+            self._probe_compiler_so(),
+            sorted(settings['include_dirs']),
+            sys.platform,
+        ]
+    )
+    def check_sys_un_h(self, settings):
+        """check whether sys/un.h is available"""
+        # don't link against anything when checking for sys/un.h
+        minus_zmq = {
+            key: list(value) if isinstance(value, list) else value
+            for key, value in settings.items()
+        }
+        minus_zmq['libraries'] = []
+        try:
+            compile_and_forget(
+                self.tempdir, pjoin('buildutils', 'check_sys_un.c'), **minus_zmq
+            )
+        except Exception as e:
+            warn("No sys/un.h, IPC_PATH_MAX_LEN will be undefined: %s" % e)
+            return False
+        else:
+            return True
 
     def create_tempdir(self):
         self.erase_tempdir()
@@ -533,7 +653,7 @@ class Configure(build_ext):
             )
             line()
 
-        if sys.platform.startswith('win'):
+        if _IS_WIN:
             # fetch libzmq.dll into local dir
             local_dll = localpath('zmq', libzmq_name + '.dll')
             if not zmq_prefix and not os.path.exists(local_dll):
@@ -559,34 +679,7 @@ class Configure(build_ext):
 
         stage_platform_hpp(pjoin(bundledir, 'zeromq'))
 
-        sources = [pjoin('buildutils', 'initlibzmq.cpp')]
-        sources.extend(
-            [
-                src
-                for src in glob(pjoin(bundledir, 'zeromq', 'src', '*.cpp'))
-                # exclude draft ws transport files
-                if not os.path.basename(src).startswith(("ws_", "wss_"))
-            ]
-        )
-
-        includes = [pjoin(bundledir, 'zeromq', 'include')]
-
-        if bundled_version < (4, 2, 0):
-            tweetnacl = pjoin(bundledir, 'zeromq', 'tweetnacl')
-            tweetnacl_sources = glob(pjoin(tweetnacl, 'src', '*.c'))
-
-            randombytes = pjoin(tweetnacl, 'contrib', 'randombytes')
-            if sys.platform.startswith('win'):
-                tweetnacl_sources.append(pjoin(randombytes, 'winrandom.c'))
-            else:
-                tweetnacl_sources.append(pjoin(randombytes, 'devurandom.c'))
-
-            sources += tweetnacl_sources
-            includes.append(pjoin(tweetnacl, 'src'))
-            includes.append(randombytes)
-        else:
-            # >= 4.2
-            sources += glob(pjoin(bundledir, 'zeromq', 'src', 'tweetnacl.c'))
+        sources, includes = self._libzmq_sources(bundledir)
 
         # construct the Extensions:
         libzmq = Extension(
@@ -601,33 +694,20 @@ class Configure(build_ext):
         self.distribution.ext_modules.insert(0, libzmq)
 
         # use tweetnacl to provide CURVE support
-        libzmq.define_macros.append(('ZMQ_HAVE_CURVE', 1))
-        libzmq.define_macros.append(('ZMQ_USE_TWEETNACL', 1))
+        libzmq.define_macros.extend([('ZMQ_HAVE_CURVE', 1), ('ZMQ_USE_TWEETNACL', 1)])
 
         # select polling subsystem based on platform
-        if sys.platform == "darwin" or "bsd" in sys.platform:
-            libzmq.define_macros.append(('ZMQ_USE_KQUEUE', 1))
-            libzmq.define_macros.append(('ZMQ_IOTHREADS_USE_KQUEUE', 1))
-            libzmq.define_macros.append(('ZMQ_POLL_BASED_ON_POLL', 1))
-        elif 'linux' in sys.platform:
-            libzmq.define_macros.append(('ZMQ_USE_EPOLL', 1))
-            libzmq.define_macros.append(('ZMQ_IOTHREADS_USE_EPOLL', 1))
-            libzmq.define_macros.append(('ZMQ_POLL_BASED_ON_POLL', 1))
-        elif sys.platform.startswith('win'):
-            libzmq.define_macros.append(('ZMQ_USE_SELECT', 1))
-            libzmq.define_macros.append(('ZMQ_IOTHREADS_USE_SELECT', 1))
-            libzmq.define_macros.append(('ZMQ_POLL_BASED_ON_SELECT', 1))
-        else:
-            # this may not be sufficiently precise
-            libzmq.define_macros.append(('ZMQ_USE_POLL', 1))
-            libzmq.define_macros.append(('ZMQ_IOTHREADS_USE_POLL', 1))
-            libzmq.define_macros.append(('ZMQ_POLL_BASED_ON_POLL', 1))
+        libzmq.define_macros.extend(_PLATFORM_MACROS[_platform_macros_key])
 
-        if sys.platform.startswith('win'):
+        if _IS_WIN:
             # include defines from zeromq msvc project:
-            libzmq.define_macros.append(('FD_SETSIZE', 16384))
-            libzmq.define_macros.append(('DLL_EXPORT', 1))
-            libzmq.define_macros.append(('_CRT_SECURE_NO_WARNINGS', 1))
+            libzmq.define_macros.extend(
+                [
+                    ('FD_SETSIZE', 16384),
+                    ('DLL_EXPORT', 1),
+                    ('_CRT_SECURE_NO_WARNINGS', 1),
+                ]
+            )
 
             # When compiling the C++ code inside of libzmq itself, we want to
             # avoid "warning C4530: C++ exception handler used, but unwind
@@ -647,7 +727,7 @@ class Configure(build_ext):
             cc = new_compiler(compiler=self.compiler_type)
             customize_compiler(cc)
             cc.output_dir = self.build_temp
-            if not sys.platform.startswith(('darwin', 'freebsd')):
+            if not (_IS_DARWIN or _IS_FREEBSD):
                 line()
                 info("checking for timer_create")
                 if not cc.has_function('timer_create'):
@@ -663,10 +743,12 @@ class Configure(build_ext):
         if not os.path.exists(pjoin(self.build_lib, bundledincludedir)):
             os.makedirs(pjoin(self.build_lib, bundledincludedir))
 
-        for header in glob(pjoin(bundledir, 'zeromq', 'include', '*.h')):
-            shutil.copyfile(header, pjoin(bundledincludedir, basename(header)))
+        with os.scandir(pjoin(bundledir, 'zeromq', 'include')) as entries:
+            headers = [entry for entry in entries if entry.name.endswith('.h')]
+        for header in headers:
+            shutil.copyfile(header.path, pjoin(bundledincludedir, header.name))
             shutil.copyfile(
-                header, pjoin(self.build_lib, bundledincludedir, basename(header))
+                header.path, pjoin(self.build_lib, bundledincludedir, header.name)
             )
 
         # update other extensions, with bundled settings
@@ -674,6 +756,67 @@ class Configure(build_ext):
         self.init_settings_from_config()
         self.save_config('config', self.config)
 
+    def _libzmq_sources(self, bundledir):
+        """The sources and include dirs of the bundled libzmq extension"""
+        sources = [pjoin('buildutils', 'initlibzmq.cpp')]
+        sources.extend(
+            scan_dir(
+                pjoin(bundledir, 'zeromq', 'src'),
+                '.cpp',
+                # exclude draft ws transport files
+                exclude=("ws_", "wss_"),
+            )
+        )
+
+        includes = [pjoin(bundledir, 'zeromq', 'include')]
+
+        if bundled_version < (4, 2, 0):
+            tweetnacl = pjoin(bundledir, 'zeromq', 'tweetnacl')
+            tweetnacl_sources = scan_dir(pjoin(tweetnacl, 'src'), '.c')
+
+            randombytes = pjoin(tweetnacl, 'contrib', 'randombytes')
+            if _IS_WIN:
+                tweetnacl_sources.append(pjoin(randombytes, 'winrandom.c'))
+            else:
+                tweetnacl_sources.append(pjoin(randombytes, 'devurandom.c'))
+
+            sources += tweetnacl_sources
+            includes.append(pjoin(tweetnacl, 'src'))
+            includes.append(randombytes)
+        else:
+            # >= 4.2
+            sources += glob(pjoin(bundledir, 'zeromq', 'src', 'tweetnacl.c'))
+        return sources, includes
+
+    def _libzmq_up_to_date(self):
+        """Check whether the bundled libzmq extension is already built
+
+        True if the built extension is newer than the libzmq sources and headers
+        and the config saved by the last run matches the current one,
+        in which case it doesn't need to be set up again.
+        """
+        build_ext = self.distribution.get_command_obj('build_ext')
+        if self.force or build_ext.force:
+            return False
+        # zmq/libzmq.cpython-...so
+        filename = self.get_ext_filename('zmq.libzmq')
+        if build_ext.inplace:
+            libzmq_path = localpath(filename)
+        else:
+            libzmq_path = pjoin(self.build_lib, filename)
+        try:
+            built = os.stat(libzmq_path).st_mtime
+        except OSError:
+            return False
+
+        # the same files bundle_libzmq_extension would build, plus headers
+        sources, includes = self._libzmq_sources('bundled')
+        for include_dir in includes + [pjoin('bundled', 'zeromq', 'src')]:
+            sources.extend(scan_dir(include_dir, ('.h', '.hpp')))
+        if max(os.stat(src).st_mtime for src in sources) > built:
+            return False
+        return load_config('config', self.build_base) == self.config
+
     def fallback_on_bundled(self):
         """Couldn't build, fallback after waiting a while"""
 
@@ -699,27 +842,38 @@ class Configure(build_ext):
             )
         )
 
-        info(
-            '\n'.join(
-                [
-                    "You can skip all this detection/waiting nonsense if you know",
-                    "you want pyzmq to bundle libzmq as an extension by passing:",
-                    "",
-                    "    `--zmq=bundled`",
-                    "",
-                    "I will now try to build libzmq as a Python extension",
-                    "unless you interrupt me (^C) in the next 10 seconds...",
-                    "",
-                ]
-            )
+        # only wait for ^C if someone could be there to press it
+        interactive = (
+            sys.stdin is not None
+            and sys.stdin.isatty()
+            and not os.environ.get('PYZMQ_BUNDLE')
+            and not os.environ.get('CI')
+            and not os.environ.get('PIP_NO_INPUT')
         )
 
-        for i in range(10, 0, -1):
-            sys.stdout.write('\r%2i...' % i)
-            sys.stdout.flush()
-            time.sleep(1)
-
-        info("")
+        msg = [
+            "You can skip all this detection/waiting nonsense if you know",
+            "you want pyzmq to bundle libzmq as an extension by passing:",
+            "",
+            "    `--zmq=bundled`",
+            "",
+        ]
+        if interactive:
+            msg += [
+                "I will now try to build libzmq as a Python extension",
+                "unless you interrupt me (^C) in the next 10 seconds...",
+                "",
+            ]
+        info('\n'.join(msg))
+
+        if interactive:
+            for i in range(10, 0, -1):
+                sys.stdout.write('\r%2i...' % i)
+                sys.stdout.flush()
+                time.sleep(1)
+            info("")
+        else:
+            info("Auto-bundling libzmq (non-interactive)")
 
         return self.bundle_libzmq_extension()
 
@@ -730,10 +884,14 @@ class Configure(build_ext):
         line()
         info("Configure: Autodetecting ZMQ settings...")
         info("    Custom ZMQ dir:       %s" % prefix)
+        # detect_zmq may add librt in place, which the extensions need as well
+        libraries = list(settings['libraries'])
         try:
             detected = detect_zmq(self.tempdir, compiler=self.compiler_type, **settings)
         finally:
             self.erase_tempdir()
+        if settings['libraries'] != libraries:
+            self.apply_compiler_settings()
 
         info("    ZMQ version detected: %s" % v_str(detected['vers']))
 
@@ -747,7 +905,10 @@ class Configure(build_ext):
         cfg = self.config
 
         if cfg['libzmq_extension']:
-            self.bundle_libzmq_extension()
+            if self._libzmq_up_to_date():
+                info("Bundled libzmq is up to date")
+            else:
+                self.bundle_libzmq_extension()
             self.finish_run()
             return
 
@@ -761,11 +922,7 @@ class Configure(build_ext):
         zmq_prefix = cfg['zmq_prefix']
         # There is no available default on Windows, so start with fallback unless
         # zmq was given explicitly, or libzmq extension was explicitly prohibited.
-        if (
-            sys.platform.startswith("win")
-            and not cfg['no_libzmq_extension']
-            and not zmq_prefix
-        ):
+        if _IS_WIN and not cfg['no_libzmq_extension'] and not zmq_prefix:
             self.fallback_on_bundled()
             self.finish_run()
             return
@@ -783,7 +940,7 @@ class Configure(build_ext):
             return
 
         # try fallback on /usr/local on *ix if no prefix is given
-        if not zmq_prefix and not sys.platform.startswith('win'):
+        if not zmq_prefix and not _IS_WIN:
             info("Failed with default libzmq, trying again with /usr/local")
             time.sleep(1)
             zmq_prefix = cfg['zmq_prefix'] = '/usr/local'
@@ -880,6 +1037,8 @@ class TestCommand(Command):
         try:
             import zmq
         except ImportError:
+            from traceback import print_exc
+
             print_exc()
             fatal(
                 '\n       '.join(
@@ -895,9 +1054,12 @@ class TestCommand(Command):
         info(
             "Testing pyzmq-%s with libzmq-%s" % (zmq.pyzmq_version(), zmq.zmq_version())
         )
-        p = Popen([sys.executable, '-m', 'pytest', '-v', os.path.join('zmq', 'tests')])
-        p.wait()
-        sys.exit(p.returncode)
+        import pytest
+
+        sys.exit(pytest.main(['-v', os.path.join('zmq', 'tests')]))
+
+
+_revision_pat = re.compile(r'^__revision__.*$', re.M)
 
 
 class GitRevisionCommand(Command):
@@ -911,34 +1073,38 @@ class GitRevisionCommand(Command):
         self.version_py = pjoin('zmq', 'sugar', 'version.py')
 
     def run(self):
-        try:
-            p = Popen('git log -1'.split(), stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        except IOError:
+        git = shutil.which('git')
+        if git is None:
             warn("No git found, skipping git revision")
             return
-
-        if p.wait():
-            warn("checking git branch failed")
-            info(p.stderr.read())
+        try:
+            p = subprocess.run(
+                [git, 'rev-parse', 'HEAD'],
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                text=True,
+                timeout=10,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            warn("checking git revision failed: %s" % e)
             return
 
-        line = p.stdout.readline().decode().strip()
-        if not line.startswith('commit'):
-            warn("bad commit line: %r" % line)
+        if p.returncode:
+            warn("checking git branch failed")
+            info(p.stderr)
             return
 
-        rev = line.split()[-1]
+        rev = p.stdout.strip()
 
         # now that we have the git revision, we can apply it to version.py
         with open(self.version_py) as f:
-            lines = f.readlines()
+            text = f.read()
 
-        for i, line in enumerate(lines):
-            if line.startswith('__revision__'):
-                lines[i] = "__revision__ = '%s'\n" % rev
-                break
-        with open(self.version_py, 'w') as f:
-            f.writelines(lines)
+        new_text = _revision_pat.sub("__revision__ = '%s'" % rev, text, count=1)
+        # leave version.py (and its mtime) alone if it's already up to date
+        if new_text != text:
+            with open(self.version_py, 'w') as f:
+                f.write(new_text)
 
     def finalize_options(self):
         pass
@@ -967,36 +1133,25 @@ class CleanCommand(Command):
             if os.path.exists(d):
                 _clean_trees.append(d)
 
-        for root, dirs, files in os.walk('buildutils'):
-            if any(root.startswith(pre) for pre in _clean_trees):
-                continue
-            for f in files:
-                if os.path.splitext(f)[-1] == '.pyc':
-                    _clean_me.append(pjoin(root, f))
-
-            if '__pycache__' in dirs:
-                _clean_trees.append(pjoin(root, '__pycache__'))
-
-        for root, dirs, files in os.walk('zmq'):
-            if any(root.startswith(pre) for pre in _clean_trees):
-                continue
-
-            for f in files:
-                if os.path.splitext(f)[-1] in ('.pyc', '.so', '.o', '.pyd', '.json'):
-                    _clean_me.append(pjoin(root, f))
-
-            # remove generated cython files
-            if self.all:
+        to_walk = [
+            ('buildutils', ('.pyc',)),
+            ('zmq', ('.pyc', '.so', '.o', '.pyd', '.json')),
+        ]
+        for top, exts in to_walk:
+            for root, dirs, files in os.walk(top):
+                if '__pycache__' in dirs:
+                    # removed as a whole, no need to look inside
+                    dirs.remove('__pycache__')
+                    _clean_trees.append(pjoin(root, '__pycache__'))
+
+                if self.all:
+                    pyx_names = {f[:-4] for f in files if f.endswith('.pyx')}
                 for f in files:
-                    f2 = os.path.splitext(f)
-                    if f2[1] == '.c' and os.path.isfile(
-                        os.path.join(root, f2[0]) + '.pyx'
-                    ):
+                    if f.endswith(exts):
+                        _clean_me.append(pjoin(root, f))
+                    # remove generated cython files
+                    elif self.all and f.endswith('.c') and f[:-2] in pyx_names:
                         _clean_me.append(pjoin(root, f))
-
-            for d in dirs:
-                if d == '__pycache__':
-                    _clean_trees.append(pjoin(root, d))
 
         bundled = glob(pjoin('zmq', 'libzmq*'))
         _clean_me.extend([b for b in bundled if b not in _clean_me])
@@ -1018,23 +1173,28 @@ class CleanCommand(Command):
                 print(e, file=sys.stderr)
 
 
+@functools.lru_cache(maxsize=None)
+def _find_pyx():
+    """Return the .pyx files in the zmq package"""
+    pyxfiles = []
+    for root, dirs, files in os.walk('zmq'):
+        # don't descend into bytecode caches or hidden directories
+        dirs[:] = [d for d in dirs if d != '__pycache__' and d[:1] != '.']
+        for f in files:
+            if f.endswith('.pyx'):
+                pyxfiles.append(pjoin(root, f))
+    return pyxfiles
+
+
 class CheckSDist(sdist):
     """Custom sdist that ensures Cython has compiled all pyx files to c."""
 
-    def initialize_options(self):
-        sdist.initialize_options(self)
-        self._pyxfiles = []
-        for root, dirs, files in os.walk('zmq'):
-            for f in files:
-                if f.endswith('.pyx'):
-                    self._pyxfiles.append(pjoin(root, f))
-
     def run(self):
         self.run_command('fetch_libzmq')
         if 'cython' in cmdclass:
             self.run_command('cython')
         else:
-            for pyxfile in self._pyxfiles:
+            for pyxfile in _find_pyx():
                 cfile = pyxfile[:-3] + 'c'
                 msg = (
                     "C-source file '%s' not found." % (cfile)
@@ -1044,6 +1204,51 @@ class CheckSDist(sdist):
         sdist.run(self)
 
 
+def _is_compiler_cache(cmd):
+    """Whether cmd is a compiler cache, e.g. the first word of CC='ccache gcc'"""
+    name = os.path.splitext(os.path.basename(cmd))[0]
+    return cmd == compiler_launcher or name in ('ccache', 'sccache')
+
+
+def cxx_compiler_so(compiler):
+    """Return compiler.compiler_so, with the C compiler replaced by C++"""
+    compiler_so = compiler.compiler_so
+    launcher = []
+    if _is_compiler_cache(compiler_so[0]):
+        launcher, compiler_so = compiler_so[:1], compiler_so[1:]
+    compiler_cxx = compiler.compiler_cxx
+    if _is_compiler_cache(compiler_cxx[0]):
+        # CXX='ccache g++' brings its own
+        launcher = []
+    if compiler_so[: len(compiler_cxx)] == compiler_cxx:
+        # already C++, e.g. inside use_cxx
+        return launcher + compiler_so
+    return launcher + compiler_cxx + compiler_so[1:]
+
+
+@contextmanager
+def compiler_cache(compiler):
+    """Run compile commands through compiler_launcher (ccache) in this context
+
+    Only compiling is affected, linking is left alone.
+    """
+    compiler_so_save = getattr(compiler, 'compiler_so', None)
+    if (
+        not compiler_launcher
+        or not compiler_so_save
+        or _is_compiler_cache(compiler_so_save[0])
+    ):
+        # no cache, msvc, which doesn't have compiler_so,
+        # or already cached, e.g. CC='ccache gcc'
+        yield
+        return
+    compiler.compiler_so = [compiler_launcher] + compiler_so_save
+    try:
+        yield
+    finally:
+        compiler.compiler_so = compiler_so_save
+
+
 @contextmanager
 def use_cxx(compiler):
     """use C++ compiler in this context
@@ -1051,7 +1256,7 @@ def use_cxx(compiler):
     used in fix_cxx which detects when C++ should be used
     """
     compiler_so_save = compiler.compiler_so[:]
-    compiler_so_cxx = compiler.compiler_cxx + compiler.compiler_so[1:]
+    compiler_so_cxx = cxx_compiler_so(compiler)
     # actually use CXX compiler
     compiler.compiler_so = compiler_so_cxx
     try:
@@ -1072,7 +1277,16 @@ def fix_cxx(compiler, extension):
         # no c++, nothing to do
         yield
         return
+    src_exts = [os.path.splitext(src)[1] for src in extension.sources]
+    if all(compiler.language_map.get(ext) == "c++" for ext in src_exts):
+        # only c++, use the C++ compiler for the whole extension
+        with use_cxx(compiler):
+            yield
+        return
     _compile_save = compiler._compile
+    # usually the class's method, which must not be left behind bound
+    # to this compiler, where copy.copy(compiler) would pick it up
+    had_compile = '_compile' in vars(compiler)
 
     def _compile_cxx(obj, src, ext, *args, **kwargs):
         if compiler.language_map.get(ext) == "c++":
@@ -1085,7 +1299,119 @@ def fix_cxx(compiler, extension):
     try:
         yield
     finally:
-        compiler._compile = _compile_save
+        if had_compile:
+            compiler._compile = _compile_save
+        else:
+            del compiler._compile
+
+
+@contextmanager
+def parallel_compile(compiler, jobs):
+    """Compile the sources of each extension in parallel
+
+    distutils only parallelizes across extensions,
+    but the bundled libzmq is a single extension with ~100 C++ sources.
+    Dependency checks are done serially, only the compiler calls run in threads.
+
+    C++ sources are compiled with a copy of the compiler using CXX,
+    instead of fix_cxx's wrapper, which swaps compiler_so in place
+    and is not thread-safe.
+    """
+    if (
+        not jobs
+        or jobs <= 1
+        or getattr(compiler.compile, '__func__', None) is not CCompiler.compile
+    ):
+        # serial, or a compiler with its own compile() (msvc)
+        yield
+        return
+
+    import copy
+
+    cxx_compiler = copy.copy(compiler)
+    cxx_compiler.compiler_so = cxx_compiler_so(compiler)
+    # call the class's _compile to bypass fix_cxx's per-source wrapper
+    _compile = type(compiler)._compile
+
+    def compile(
+        sources,
+        output_dir=None,
+        macros=None,
+        include_dirs=None,
+        debug=0,
+        extra_preargs=None,
+        extra_postargs=None,
+        depends=None,
+    ):
+        macros, objects, extra_postargs, pp_opts, build = compiler._setup_compile(
+            output_dir, macros, include_dirs, sources, depends, extra_postargs
+        )
+        cc_args = compiler._get_cc_args(pp_opts, debug, extra_preargs)
+
+        def compile_one(obj):
+            src, ext = build[obj]
+            if compiler.language_map.get(ext) == "c++":
+                cc = cxx_compiler
+            else:
+                cc = compiler
+            _compile(cc, obj, src, ext, cc_args, extra_postargs, pp_opts)
+
+        with ThreadPoolExecutor(jobs) as pool:
+            # consume the results to raise the first CompileError, if any
+            list(pool.map(compile_one, [obj for obj in objects if obj in build]))
+        return objects
+
+    compiler.compile = compile
+    try:
+        yield
+    finally:
+        del compiler.compile
+
+
+def build_jobs():
+    """Default number of parallel compile jobs for build_ext
+
+    From $PYZMQ_BUILD_JOBS or $SETUPTOOLS_BUILD_EXT_PARALLEL,
+    otherwise the number of CPUs.
+    """
+    for var in ('PYZMQ_BUILD_JOBS', 'SETUPTOOLS_BUILD_EXT_PARALLEL'):
+        jobs = os.environ.get(var)
+        if jobs:
+            return int(jobs)
+    return os.cpu_count() or 1
+
+
+def build_extensions_parallel(cmd, extensions):
+    """Build extensions with a build_ext command, up to cmd.parallel at a time
+
+    libzmq is built first, on its own, since the others may link against it.
+    The rest are built in threads, each with its own copy of the command
+    and compiler, because build_extension and our compiler context managers
+    modify them.
+    """
+    libs = [ext for ext in extensions if ext.name.startswith('zmq.lib')]
+    others = [ext for ext in extensions if not ext.name.startswith('zmq.lib')]
+    for ext in libs:
+        cmd.build_extension(ext)
+
+    jobs = cmd.parallel or 1
+    if jobs <= 1 or len(others) <= 1 or cmd.compiler.compiler_type == 'msvc':
+        for ext in others:
+            cmd.build_extension(ext)
+        return
+
+    import copy
+
+    def build_one(ext):
+        ext_cmd = copy.copy(cmd)
+        ext_cmd.compiler = copy.copy(cmd.compiler)
+        # already one extension per thread, don't parallelize within it
+        ext_cmd.parallel = 1
+        ext_cmd.build_extension(ext)
+
+    with ThreadPoolExecutor(jobs) as pool:
+        # consume the results to raise the first error, if any
+        list(pool.map(build_one, others))
 
 
 class CheckingBuildExt(build_ext):
@@ -1110,11 +1436,12 @@ class CheckingBuildExt(build_ext):
         if self.compiler.compiler_type == 'mingw32':
             customize_mingw(self.compiler)
 
-        for ext in self.extensions:
-            self.build_extension(ext)
+        build_extensions_parallel(self, self.extensions)
 
     def build_extension(self, ext):
-        with fix_cxx(self.compiler, ext):
+        with compiler_cache(self.compiler), fix_cxx(
+            self.compiler, ext
+        ), parallel_compile(self.compiler, self.parallel):
             super().build_extension(ext)
 
         ext_path = self.get_ext_fullpath(ext.name)
@@ -1123,7 +1450,9 @@ class CheckingBuildExt(build_ext):
     def finalize_options(self):
         # check version, to prevent confusing undefined constant errors
         self.distribution.run_command("configure")
-        return super().finalize_options()
+        super().finalize_options()
+        if not self.parallel:
+            self.parallel = build_jobs()
 
 
 class ConstantsCommand(Command):
@@ -1162,15 +1491,30 @@ cmdclass = {
 # -----------------------------------------------------------------------------
 
 
+@functools.lru_cache(maxsize=None)
 def makename(path, ext):
     return os.path.abspath(pjoin('zmq', *path)) + ext
 
 
-pxd = lambda *path: makename(path, '.pxd')
-pxi = lambda *path: makename(path, '.pxi')
-pyx = lambda *path: makename(path, '.pyx')
-dotc = lambda *path: makename(path, '.c')
-doth = lambda *path: makename(path, '.h')
+def pxd(*path):
+    return makename(path, '.pxd')
+
+
+def pxi(*path):
+    return makename(path, '.pxi')
+
+
+def pyx(*path):
+    return makename(path, '.pyx')
+
+
+def dotc(*path):
+    return makename(path, '.c')
+
+
+def doth(*path):
+    return makename(path, '.h')
+
 
 libzmq = pxd('backend', 'cython', 'libzmq')
 buffers = pxd('utils', 'buffers')
@@ -1199,24 +1543,55 @@ submodules = {
     },
 }
 
+
+def _vtuple(v):
+    """Version string as a tuple of ints, for comparisons
+
+    Stops at the first part that isn't purely numeric,
+    e.g. '3.0.0a10' -> (3, 0, 0)
+    """
+    parts = []
+    for part in v.split('.'):
+        digits = part[: len(part) - len(part.lstrip('0123456789'))]
+        if not digits:
+            break
+        parts.append(int(digits))
+        if digits != part:
+            break
+    return tuple(parts)
+
+
 # require cython 0.29
 min_cython_version = "0.29"
 cython_language_level = "3str"
 
-try:
-    import Cython
+# commands that never compile anything, and don't need Cython
+_no_cython_commands = {'clean', 'constants', 'fetch_libzmq', 'revision', 'test'}
 
-    if V(Cython.__version__) < V(min_cython_version):
-        raise ImportError(
-            "Cython >= %s required for cython build, found %s"
-            % (min_cython_version, Cython.__version__)
-        )
-    from Cython.Build import cythonize
-    from Cython.Distutils.build_ext import new_build_ext as build_ext_cython
+# e.g. `setup.py clean` or `setup.py --version`,
+# don't pay for importing Cython
+need_cython = not all(
+    arg.startswith('-') or arg in _no_cython_commands for arg in sys.argv[1:]
+)
 
-    cython = True
-except Exception:
-    cython = False
+cython = False
+if need_cython:
+    try:
+        import Cython
+
+        if _vtuple(Cython.__version__) < _vtuple(min_cython_version):
+            raise ImportError(
+                "Cython >= %s required for cython build, found %s"
+                % (min_cython_version, Cython.__version__)
+            )
+        from Cython.Build import cythonize
+        from Cython.Distutils.build_ext import new_build_ext as build_ext_cython
+
+        cython = True
+    except Exception:
+        pass
+
+if not cython:
     suffix = '.c'
     cmdclass['build_ext'] = CheckingBuildExt
 
@@ -1237,7 +1612,7 @@ except Exception:
                 warn("Cython is missing")
             else:
                 cv = getattr(Cython, "__version__", None)
-                if cv is None or V(cv) < V(min_cython_version):
+                if cv is None or _vtuple(cv) < _vtuple(min_cython_version):
                     warn(
                         "Cython >= %s is required for compiling Cython sources, "
                         "found: %s" % (min_cython_version, cv or Cython)
@@ -1263,17 +1638,22 @@ else:
         def build_extensions(self):
             if self.compiler.compiler_type == 'mingw32':
                 customize_mingw(self.compiler)
-            return super().build_extensions()
+            self.check_extensions_list(self.extensions)
+            build_extensions_parallel(self, self.extensions)
 
         def build_extension(self, ext):
-            with fix_cxx(self.compiler, ext):
+            with compiler_cache(self.compiler), fix_cxx(
+                self.compiler, ext
+            ), parallel_compile(self.compiler, self.parallel):
                 super().build_extension(ext)
             ext_path = self.get_ext_fullpath(ext.name)
             patch_lib_paths(ext_path, self.compiler.library_dirs)
 
         def finalize_options(self):
             self.distribution.run_command("configure")
-            return super().finalize_options()
+            super().finalize_options()
+            if not self.parallel:
+                self.parallel = build_jobs()
 
     cmdclass["cython"] = CythonCommand
     cmdclass["build_ext"] = zbuild_ext
@@ -1285,8 +1665,9 @@ ext_kwargs = {
 }
 
 for submod, packages in submodules.items():
+    sub_path = pjoin("zmq", submod.replace(".", os.path.sep))
     for pkg in sorted(packages):
-        sources = [pjoin("zmq", submod.replace(".", os.path.sep), pkg + suffix)]
+        sources = [pjoin(sub_path, pkg + suffix)]
         ext = Extension("zmq.%s.%s" % (submod, pkg), sources=sources, **ext_kwargs)
         extensions.append(ext)
 
@@ -1294,9 +1675,21 @@ if cython:
     # set binding so that compiled methods can be inspected
     # set language-level to 3str, requires Cython 0.29
     cython_directives = {"binding": True, "language_level": "3str"}
+    cythonize_kwargs = {}
     if os.environ.get("PYZMQ_CYTHON_COVERAGE"):
         cython_directives["linetrace"] = True
-    extensions = cythonize(extensions, compiler_directives=cython_directives)
+    else:
+        # reuse generated C for unchanged sources across builds.
+        # set PYZMQ_CYTHON_CACHE to another directory, or empty to disable.
+        cython_cache = os.environ.get(
+            "PYZMQ_CYTHON_CACHE", pjoin("build", "cython-cache")
+        )
+        if cython_cache:
+            os.makedirs(cython_cache, exist_ok=True)
+            cythonize_kwargs["cache"] = cython_cache
+    extensions = cythonize(
+        extensions, compiler_directives=cython_directives, **cythonize_kwargs
+    )
 
 if pypy:
     extensions = []
@@ -1320,36 +1713,34 @@ package_data = {
 def extract_version():
     """extract pyzmq version from sugar/version.py, so it's not multiply defined"""
     with open(pjoin('zmq', 'sugar', 'version.py')) as f:
-        while True:
-            line = f.readline()
-            if line.startswith('VERSION'):
-                lines = ["from typing import *\n"]
-                while line and not line.startswith('def'):
-                    lines.append(line)
-                    line = f.readline()
-                break
-    ns = {}
-    exec(''.join(lines), ns)
-    return ns['__version__']
+        text = f.read()
+    # VERSION_MAJOR = 22, ..., VERSION_EXTRA = "dev"
+    parts = dict(
+        re.findall(r'^VERSION_(MAJOR|MINOR|PATCH|EXTRA)\s*=\s*(.*?)\s*$', text, re.M)
+    )
+    version = '%i.%i.%i' % tuple(int(parts[key]) for key in ('MAJOR', 'MINOR', 'PATCH'))
+    extra = parts['EXTRA'].strip('\'"')
+    if extra:
+        version = "%s.%s" % (version, extra)
+    return version
 
 
 def find_packages():
     """adapted from IPython's setupbase.find_packages()"""
-    packages = []
-    for dir, subdirs, files in os.walk('zmq'):
-        package = dir.replace(os.path.sep, '.')
-        if '__init__.py' not in files:
-            # not a package
-            continue
-        packages.append(package)
-    return packages
+    from pathlib import Path
+
+    return sorted(
+        '.'.join(init.parent.parts)
+        for init in Path('zmq').rglob('__init__.py')
+        if '__pycache__' not in init.parts
+    )
 
 
 # -----------------------------------------------------------------------------
 # Main setup
 # -----------------------------------------------------------------------------
 
-with io.open('README.md', encoding='utf-8') as f:
+with open('README.md', encoding='utf-8') as f:
     long_desc = f.read()
 
 setup_args = dict(